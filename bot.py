@@ -1,6 +1,10 @@
+import json
 import logging
 import os
 import re
+import threading
+import time
+from collections import defaultdict
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from telegram import (
@@ -11,11 +15,13 @@ from telegram import (
 )
 from telegram.ext import (
     Updater,
+    BasePersistence,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
     Filters,
+    TypeHandler,
     CallbackContext,
 )
 
@@ -35,6 +41,19 @@ if not all([TOKEN, SPREADSHEET_ID, WEB_APP_URL]):
     # Hentikan bot jika konfigurasi penting tidak ada
     exit()
 
+# Percakapan yang menganggur lebih lama dari ini (detik) akan diakhiri otomatis
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", "600"))
+# Jumlah maksimum pengguna yang datanya (user_data) disimpan di memori
+USER_DATA_MAXSIZE = int(os.getenv("USER_DATA_MAXSIZE", "500"))
+# ID Telegram (pisahkan dengan koma) yang boleh memakai perintah admin seperti /stats
+ADMIN_IDS = [int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()]
+# Tab spreadsheet untuk snapshot state percakapan dan indeks toko/rak, serta interval
+# penulisannya (detik). Disimpan di spreadsheet karena filesystem dyno tidak permanen.
+STATE_SHEET = os.getenv("STATE_SHEET", "_bot_state")
+PERSISTENCE_INTERVAL = int(os.getenv("PERSISTENCE_INTERVAL", "60"))
+# Interval validasi ulang indeks toko/rak dari Google Sheets (detik)
+SHEET_INDEX_REFRESH = int(os.getenv("SHEET_INDEX_REFRESH", "300"))
+
 # --- Definisi State untuk ConversationHandler ---
 (SELECTING_ACTION,
  ADD_STORE_NAME, SELECT_STORE_TO_DELETE, CONFIRM_DELETE_STORE,
@@ -61,22 +80,373 @@ except Exception as e:
     exit()
 
 
+# --- Penyimpanan Data Pengguna (dibatasi) ---
+# Jumlah percakapan yang diakhiri karena menganggur dan data pengguna yang dibuang (LRU)
+conversation_stats = {'expired': 0, 'evicted': 0}
+# Penghitung dinaikkan dari thread dispatcher dan beberapa thread job queue sekaligus
+conversation_stats_lock = threading.Lock()
+
+
+def count_stat(name):
+    """Menaikkan salah satu penghitung di conversation_stats secara thread-safe."""
+    with conversation_stats_lock:
+        conversation_stats[name] += 1
+
+
+class BoundedUserData(defaultdict):
+    """Pengganti `dispatcher.user_data` berukuran terbatas (LRU).
+
+    Setiap akses memindahkan pengguna ke posisi terbaru. Jika jumlah pengguna
+    melebihi `maxsize`, data pengguna yang paling lama tidak aktif dibuang.
+    Pengguna yang masih berada di tengah percakapan tidak pernah dibuang;
+    `conversation_keys` mengembalikan kunci (chat_id, user_id) percakapan aktif,
+    `on_drop` dipanggil untuk setiap pengguna yang dibuang (misal: ke persistence).
+    """
+
+    def __init__(self, maxsize, initial=None, conversation_keys=None, on_drop=None):
+        super().__init__(dict)
+        self.maxsize = maxsize
+        self.conversation_keys = conversation_keys or (lambda: [])
+        self.on_drop = on_drop or (lambda user_id: None)
+        if initial:
+            for user_id, data in initial.items():
+                self[user_id] = data
+
+    def __getitem__(self, user_id):
+        if user_id in self:
+            # Pindahkan ke posisi paling baru
+            self.move_to_end(user_id)
+            return super().__getitem__(user_id)
+        data = super().__getitem__(user_id)  # dibuat oleh default_factory
+        self._evict()
+        return data
+
+    def __setitem__(self, user_id, data):
+        if user_id in self:
+            super().__delitem__(user_id)
+        super().__setitem__(user_id, data)
+        self._evict()
+
+    def active_chats(self, user_id):
+        """Mengembalikan chat_id tempat pengguna masih memiliki percakapan aktif."""
+        return {key[0] for key in self.conversation_keys() if key[-1] == user_id}
+
+    def drop(self, user_id):
+        """Membuang data seorang pengguna dari memori."""
+        self.pop(user_id, None)
+        self.on_drop(user_id)
+
+    def move_to_end(self, user_id):
+        data = super().pop(user_id)
+        super().__setitem__(user_id, data)
+
+    def _evict(self):
+        if len(self) <= self.maxsize:
+            return
+        active = {key[-1] for key in self.conversation_keys()}
+        # Pengguna terbaru (yang sedang diakses) tidak ikut dibuang
+        for user_id in list(self)[:-1]:
+            if len(self) <= self.maxsize:
+                break
+            if user_id in active:
+                continue
+            super().__delitem__(user_id)
+            count_stat('evicted')
+            self.on_drop(user_id)
+            logger.debug(f"Data pengguna {user_id} dibuang dari memori (LRU).")
+
+
+# --- Persistence (Google Sheets) ---
+class SheetPersistence(BasePersistence):
+    """Menyimpan state percakapan, user_data dan bot_data di sebuah tab spreadsheet.
+
+    Snapshot disimpan sebagai JSON yang dipecah per sel di kolom A. Persistence memegang
+    salinannya sendiri yang dilindungi `lock`, jadi `snapshot()` tidak bentrok dengan
+    thread dispatcher maupun job queue. Data hanya ditulis ke spreadsheet lewat `write()`.
+    """
+
+    CHUNK_SIZE = 40000  # Batas isi satu sel adalah 50.000 karakter
+    LOAD_ATTEMPTS = 3
+
+    def __init__(self, spreadsheet, sheet_title):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=True)
+        self.spreadsheet = spreadsheet
+        self.sheet_title = sheet_title
+        self.worksheet = None
+        # False selama snapshot lama belum berhasil dibaca; write() tidak boleh menimpanya
+        self.loaded = False
+        self.user_data = None
+        self.bot_data = None
+        self.conversations = None  # nama handler -> {kunci: (state, waktu aktivitas terakhir)}
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.last_payload = None
+        self.rows_written = 0
+
+    def load(self):
+        """Membaca snapshot sekali saat start. Percakapan yang sudah melewati
+        CONVERSATION_TIMEOUT dibuang, begitu juga user_data tanpa percakapan aktif."""
+        if self.conversations is not None:
+            return
+        data = {}
+        for attempt in range(1, self.LOAD_ATTEMPTS + 1):
+            try:
+                payload = self.read_snapshot()
+            except Exception as e:
+                logger.warning(f"Gagal membaca snapshot state (percobaan {attempt}): {e}")
+                if attempt < self.LOAD_ATTEMPTS:
+                    time.sleep(attempt)
+                continue
+            self.loaded = True
+            try:
+                data = json.loads(payload) if payload else {}
+            except ValueError as e:
+                logger.error(f"Snapshot state rusak, mulai dari kosong: {e}")
+            break
+        else:
+            logger.error("Snapshot state tidak terbaca, mulai dari kosong. "
+                         "Penyimpanan ditunda sampai snapshot lama berhasil dibaca.")
+
+        now = time.time()
+        conversations = {}
+        for name, entries in data.get('conversations', {}).items():
+            conversations[name] = {tuple(key): (state, last_activity)
+                                   for key, state, last_activity in entries
+                                   if now - last_activity < CONVERSATION_TIMEOUT}
+        active_users = {key[-1] for entries in conversations.values() for key in entries}
+        self.conversations = conversations
+        self.user_data = {int(user_id): user_data for user_id, user_data in data.get('user_data', {}).items()
+                          if int(user_id) in active_users}
+        self.bot_data = data.get('bot_data', {})
+        logger.info(f"Snapshot state dimuat: {len(active_users)} pengguna dengan percakapan aktif.")
+
+    def read_snapshot(self):
+        """Membaca isi tab STATE_SHEET; string kosong jika tab belum ada."""
+        try:
+            worksheet = self.spreadsheet.worksheet(self.sheet_title)
+        except gspread.exceptions.WorksheetNotFound:
+            self.rows_written = 0
+            return ""
+        chunks = worksheet.col_values(1)
+        self.worksheet = worksheet
+        self.last_payload = "".join(chunks)
+        self.rows_written = len(chunks)
+        return self.last_payload
+
+    def get_user_data(self):
+        self.load()
+        with self.lock:
+            return defaultdict(dict, self.user_data)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        self.load()
+        with self.lock:
+            return dict(self.bot_data)
+
+    def get_conversations(self, name):
+        self.load()
+        with self.lock:
+            return {key: state for key, (state, _) in self.conversations.get(name, {}).items()}
+
+    def conversation_deadlines(self, name):
+        """Waktu kedaluwarsa (epoch) setiap percakapan milik handler `name`."""
+        with self.lock:
+            return {key: last_activity + CONVERSATION_TIMEOUT
+                    for key, (_, last_activity) in self.conversations.get(name, {}).items()}
+
+    def update_conversation(self, name, key, new_state):
+        with self.lock:
+            entries = self.conversations.setdefault(name, {})
+            if new_state is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = (new_state, time.time())
+
+    def update_user_data(self, user_id, data):
+        with self.lock:
+            self.user_data[user_id] = data
+
+    def drop_user_data(self, user_id):
+        with self.lock:
+            self.user_data.pop(user_id, None)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        with self.lock:
+            self.bot_data = data
+
+    def snapshot(self):
+        """Menyusun snapshot JSON dari salinan yang dipegang persistence."""
+        with self.lock:
+            return json.dumps({
+                'conversations': {name: [[list(key), state, last_activity]
+                                         for key, (state, last_activity) in entries.items()]
+                                  for name, entries in self.conversations.items()},
+                'user_data': {str(user_id): data for user_id, data in self.user_data.items()},
+                'bot_data': self.bot_data,
+            })
+
+    def write(self, payload):
+        """Menulis snapshot ke tab STATE_SHEET jika ada perubahan (satu request update)."""
+        with self.write_lock:
+            if not self.loaded:
+                # Coba baca lagi agar snapshot lama tidak tertimpa tanpa pernah terbaca
+                try:
+                    self.read_snapshot()
+                except Exception as e:
+                    logger.error(f"Snapshot lama masih tidak terbaca, penyimpanan ditunda: {e}")
+                    return
+                self.loaded = True
+                logger.warning("Snapshot lama baru terbaca setelah start; isinya diganti state saat ini.")
+            if payload == self.last_payload:
+                return
+            chunks = [payload[i:i + self.CHUNK_SIZE] for i in range(0, len(payload), self.CHUNK_SIZE)]
+            # Sel sisa snapshot sebelumnya yang lebih panjang ikut dikosongkan
+            rows = max(len(chunks), self.rows_written)
+            values = [[chunk] for chunk in chunks] + [[""]] * (rows - len(chunks))
+            try:
+                if self.worksheet is None:
+                    try:
+                        self.worksheet = self.spreadsheet.worksheet(self.sheet_title)
+                    except gspread.exceptions.WorksheetNotFound:
+                        self.worksheet = self.spreadsheet.add_worksheet(title=self.sheet_title, rows=rows, cols=1)
+                if self.worksheet.row_count < rows:
+                    self.worksheet.add_rows(rows - self.worksheet.row_count)
+                self.worksheet.update(f'A1:A{rows}', values)
+            except Exception as e:
+                # Akan dicoba lagi pada snapshot berikutnya
+                logger.warning(f"Gagal menyimpan snapshot state: {e}")
+                return
+            self.last_payload = payload
+            self.rows_written = len(chunks)
+
+    def flush(self):
+        # Dipanggil Updater saat menerima sinyal berhenti
+        self.write(self.snapshot())
+
+
+# Kunci (chat_id, user_id) percakapan hasil restore yang belum disentuh pengguna sejak start
+restored_conversations = set()
+
+
+class SnapshotRequest:
+    """Penanda di update_queue agar snapshot diambil di thread dispatcher, di antara dua update."""
+
+
+# --- Indeks Toko & Rak ---
+# Disimpan di bot_data sehingga ikut snapshot dan langsung terpakai setelah restart.
+# 'stores': daftar kode toko (None = belum diambil), 'raks': kode toko -> daftar nama rak
+sheet_index = {'stores': None, 'raks': {}}
+# Nomor generasi per entri ('stores' atau kode toko), dinaikkan setiap kali entri di-invalidate.
+# Hasil pengambilan yang dimulai sebelum invalidate tidak boleh menimpa entri tersebut.
+sheet_index_generation = defaultdict(int)
+sheet_index_lock = threading.Lock()
+
+
 # --- Fungsi Bantuan (Helpers) ---
+def store_codes_from(titles):
+    """Menyaring nama sheet yang valid sebagai kode toko."""
+    return [title for title in titles if len(title) == 4 and title.isalnum()]
+
 def get_store_codes():
-    """Mengambil semua nama sheet yang valid sebagai kode toko."""
-    try:
-        return [s.title for s in spreadsheet.worksheets() if len(s.title) == 4 and s.title.isalnum()]
-    except Exception as e:
-        logger.error(f"Error saat mengambil kode toko: {e}")
-        return []
+    """Mengambil semua kode toko, dari indeks jika sudah ada."""
+    with sheet_index_lock:
+        stores = sheet_index['stores']
+        generation = sheet_index_generation['stores']
+    if stores is None:
+        try:
+            stores = store_codes_from(s.title for s in spreadsheet.worksheets())
+        except Exception as e:
+            logger.error(f"Error saat mengambil kode toko: {e}")
+            return []
+        with sheet_index_lock:
+            if sheet_index_generation['stores'] == generation:
+                sheet_index['stores'] = stores
+    return list(stores)
 
 def get_rak_names(worksheet):
-    """Mengambil semua nama rak (named ranges) dari sebuah worksheet."""
+    """Mengambil semua nama rak (named ranges) dari sebuah worksheet, dari indeks jika sudah ada."""
+    store_code = worksheet.title
+    with sheet_index_lock:
+        raks = sheet_index['raks'].get(store_code)
+        generation = sheet_index_generation[store_code]
+    if raks is None:
+        try:
+            raks = [nr['name'] for nr in worksheet.list_named_ranges()]
+        except Exception as e:
+            logger.error(f"Error saat mengambil nama rak: {e}")
+            return []
+        with sheet_index_lock:
+            if sheet_index_generation[store_code] == generation:
+                sheet_index['raks'][store_code] = raks
+    return list(raks)
+
+def invalidate_store_codes():
+    """Menandai daftar toko agar diambil ulang pada akses berikutnya."""
+    with sheet_index_lock:
+        sheet_index['stores'] = None
+        sheet_index_generation['stores'] += 1
+
+def invalidate_rak_names(store_code):
+    """Menandai daftar rak sebuah toko agar diambil ulang pada akses berikutnya."""
+    with sheet_index_lock:
+        sheet_index['raks'].pop(store_code, None)
+        sheet_index_generation[store_code] += 1
+
+def refresh_sheet_index(context: CallbackContext):
+    """Memvalidasi ulang indeks toko/rak di latar belakang.
+
+    Semua toko dan rak dibangun dari satu pembacaan metadata spreadsheet, sehingga kuota
+    baca tidak bertambah seiring jumlah toko. Entri yang di-invalidate selama pengambilan
+    berlangsung tidak ditimpa.
+    """
+    with sheet_index_lock:
+        generations = dict(sheet_index_generation)
     try:
-        return [nr['name'] for nr in worksheet.list_named_ranges()]
+        metadata = spreadsheet.fetch_sheet_metadata(
+            params={'fields': 'sheets(properties(sheetId,title)),namedRanges(name,range(sheetId))'})
     except Exception as e:
-        logger.error(f"Error saat mengambil nama rak: {e}")
-        return []
+        logger.warning(f"Gagal memvalidasi ulang indeks toko: {e}")
+        return
+
+    # sheetId 0 tidak dikirim oleh API, jadi nilai default-nya 0
+    titles = {sheet['properties'].get('sheetId', 0): sheet['properties']['title']
+              for sheet in metadata.get('sheets', [])}
+    stores = store_codes_from(titles.values())
+    raks = {store_code: [] for store_code in stores}
+    for named_range in metadata.get('namedRanges', []):
+        store_code = titles.get(named_range.get('range', {}).get('sheetId', 0))
+        if store_code in raks:
+            raks[store_code].append(named_range['name'])
+
+    with sheet_index_lock:
+        if sheet_index_generation['stores'] == generations.get('stores', 0):
+            sheet_index['stores'] = stores
+        for store_code in list(sheet_index['raks']):
+            if store_code not in raks and sheet_index_generation[store_code] == generations.get(store_code, 0):
+                sheet_index['raks'].pop(store_code)  # Toko sudah dihapus
+        for store_code, store_raks in raks.items():
+            if sheet_index_generation[store_code] == generations.get(store_code, 0):
+                sheet_index['raks'][store_code] = store_raks
+
+def request_snapshot(context: CallbackContext):
+    """Meminta dispatcher mengambil snapshot state secara berkala."""
+    context.dispatcher.update_queue.put(SnapshotRequest())
+
+def write_snapshot(update: SnapshotRequest, context: CallbackContext):
+    """Mengambil snapshot di thread dispatcher lalu menulisnya di latar belakang."""
+    persistence = context.dispatcher.persistence
+    try:
+        payload = persistence.snapshot()
+    except Exception as e:
+        logger.warning(f"Gagal menyusun snapshot state: {e}")
+        return
+    context.dispatcher.run_async(persistence.write, payload)
 
 def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     """Membangun keyboard inline dari daftar tombol."""
@@ -165,6 +535,63 @@ def invalid_input(update: Update, context: CallbackContext):
         update.message.reply_text("Data Salah, Harap Pilih Dari Menu", quote=True)
     # Tidak mengakhiri conversation, biarkan pengguna mencoba lagi atau membatalkan.
 
+def end_session(context: CallbackContext, chat_id, user_id, bot_message_id):
+    """Membebaskan data pengguna dari percakapan yang menganggur dan memberi tahu pengguna."""
+    count_stat('expired')
+
+    # Hapus data pengguna sepenuhnya dari memori, kecuali pengguna yang sama masih
+    # memiliki percakapan aktif di chat lain (user_data dipakai bersama antar chat)
+    user_data = context.dispatcher.user_data
+    if not user_data.active_chats(user_id) - {chat_id}:
+        user_data.drop(user_id)
+
+    if bot_message_id:
+        try:
+            context.bot.edit_message_text(chat_id=chat_id, message_id=bot_message_id,
+                                          text="Sesi berakhir karena tidak ada aktivitas. Ketik /start untuk memulai lagi.")
+        except Exception as e:
+            logger.warning(f"Tidak dapat mengedit pesan saat sesi berakhir: {e}")
+
+def conversation_timeout(update: Update, context: CallbackContext):
+    """Mengakhiri percakapan yang menganggur dan membebaskan data penggunanya."""
+    if update.callback_query and update.callback_query.message:
+        bot_message_id = update.callback_query.message.message_id
+    else:
+        bot_message_id = context.user_data.get('last_bot_message_id')
+    end_session(context, update.effective_chat.id, update.effective_user.id, bot_message_id)
+
+def mark_conversation_resumed(update: Update, context: CallbackContext):
+    """Menandai percakapan hasil restore yang sudah disentuh pengguna (group -2, sebelum
+    ConversationHandler), agar expire_restored_conversation tidak lagi mengakhirinya."""
+    if restored_conversations and update.effective_chat and update.effective_user:
+        restored_conversations.discard((update.effective_chat.id, update.effective_user.id))
+
+def expire_restored_conversation(context: CallbackContext):
+    """Mengakhiri percakapan hasil restore yang tidak dilanjutkan sebelum CONVERSATION_TIMEOUT."""
+    conv_handler, key = context.job.context
+    # Lock yang sama dengan _trigger_timeout milik PTB. check_update membaca state di bawah
+    # _conversations_lock setelah mark_conversation_resumed, jadi update pengguna tidak bisa
+    # masuk ke state lama setelah pengecekan ini.
+    with conv_handler._timeout_jobs_lock, conv_handler._conversations_lock:
+        if (key not in restored_conversations or key not in conv_handler.conversations
+                or key in conv_handler.timeout_jobs):
+            return  # Sudah dilanjutkan atau sudah berakhir
+        restored_conversations.discard(key)
+        del conv_handler.conversations[key]
+        context.dispatcher.persistence.update_conversation(conv_handler.name, key, None)
+    chat_id, user_id = key
+    bot_message_id = context.dispatcher.user_data.get(user_id, {}).get('last_bot_message_id')
+    end_session(context, chat_id, user_id, bot_message_id)
+
+def stats(update: Update, context: CallbackContext):
+    """Menampilkan statistik memori percakapan (khusus admin)."""
+    user_data = context.dispatcher.user_data
+    update.message.reply_text(
+        f"Data pengguna di memori: {len(user_data)}/{user_data.maxsize}\n"
+        f"Percakapan kedaluwarsa: {conversation_stats['expired']}\n"
+        f"Data pengguna dibuang (LRU): {conversation_stats['evicted']}"
+    )
+
 
 # --- Alur Tambah Toko ---
 def add_store_start(update: Update, context: CallbackContext):
@@ -196,6 +623,7 @@ def add_store_process(update: Update, context: CallbackContext):
 
     try:
         spreadsheet.add_worksheet(title=store_code, rows="100", cols="26")
+        invalidate_store_codes()
         clear_and_restart(update, context, f"Berhasil Menambahkan {store_code}")
     except Exception as e:
         logger.error(f"Gagal menambahkan sheet {store_code}: {e}")
@@ -238,6 +666,8 @@ def delete_store_execute(update: Update, context: CallbackContext):
     try:
         worksheet = spreadsheet.worksheet(store_code)
         spreadsheet.del_worksheet(worksheet)
+        invalidate_store_codes()
+        invalidate_rak_names(store_code)
         clear_and_restart(update, context, f"Kode Toko {store_code} Berhasil Dihapus")
     except Exception as e:
         logger.error(f"Error menghapus {store_code}: {e}")
@@ -326,6 +756,8 @@ def add_rak_process(update: Update, context: CallbackContext):
         except Exception as e:
             logger.error(f"Gagal membuat rak {rak_name}: {e}")
             existed.append(f"{rak_name} (gagal dibuat)")
+    if added:
+        invalidate_rak_names(store_code)
 
     # Buat pesan hasil
     result_message = ""
@@ -514,6 +946,8 @@ def delete_rak_execute(update: Update, context: CallbackContext):
         except Exception as e:
             logger.error(f"Gagal hapus rak {rak_name}: {e}")
             not_found.append(f"{rak_name} (error)")
+    if deleted:
+        invalidate_rak_names(store_code)
 
     result_message = ""
     if deleted: result_message += f"Berhasil menghapus rak: {', '.join(deleted)}\n"
@@ -638,9 +1072,21 @@ def delete_plu_execute(update: Update, context: CallbackContext):
 
 # --- Main Function ---
 def main() -> None:
-    updater = Updater(TOKEN)
+    # State percakapan, user_data dan indeks disimpan di memori lalu ditulis ke tab STATE_SHEET
+    # secara berkala (request_snapshot) dan saat bot dihentikan.
+    persistence = SheetPersistence(spreadsheet, STATE_SHEET)
+    updater = Updater(TOKEN, persistence=persistence)
     dispatcher = updater.dispatcher
 
+    # Pakai indeks dari snapshot sebelumnya agar langsung siap, lalu validasi ulang di latar belakang
+    snapshot = dispatcher.bot_data.get('sheet_index')
+    if snapshot and snapshot.get('stores') is not None:
+        sheet_index.update(snapshot)
+        logger.info("Indeks toko/rak dimuat dari snapshot.")
+    dispatcher.bot_data['sheet_index'] = sheet_index
+    conversation_stats.update(dispatcher.bot_data.get('stats') or {})
+    dispatcher.bot_data['stats'] = conversation_stats
+
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler('start', start),
@@ -674,6 +1120,8 @@ def main() -> None:
             SELECT_RAK_FOR_DELETE_PLU: [CallbackQueryHandler(delete_plu_start, pattern='^rak_')],
             LIST_PLU_TO_DELETE: [MessageHandler(Filters.text & ~Filters.command, delete_plu_confirm)],
             CONFIRM_DELETE_PLU: [CallbackQueryHandler(delete_plu_execute, pattern='^confirm_delete_plu_yes$')],
+            # Percakapan menganggur melewati CONVERSATION_TIMEOUT
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
         fallbacks=[
             CallbackQueryHandler(cancel, pattern='^cancel$'),
@@ -683,14 +1131,36 @@ def main() -> None:
         per_user=True,
         per_chat=True,
         allow_reentry=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name='pjr_conversation',
+        persistent=True,
     )
 
     dispatcher.add_handler(conv_handler)
+    # PTB hanya memasang job timeout saat ada update, jadi percakapan hasil restore dijadwalkan di sini
+    for key, expires_at in persistence.conversation_deadlines(conv_handler.name).items():
+        restored_conversations.add(key)
+        dispatcher.job_queue.run_once(expire_restored_conversation, max(expires_at - time.time(), 0),
+                                      context=(conv_handler, key))
+    # Batasi jumlah user_data yang disimpan agar memori tetap stabil. Pengguna yang dibuang
+    # juga dihapus dari persistence sehingga tidak ikut tersimpan.
+    dispatcher.user_data = BoundedUserData(USER_DATA_MAXSIZE, dispatcher.user_data,
+                                           conversation_keys=lambda: list(conv_handler.conversations),
+                                           on_drop=persistence.drop_user_data)
+    dispatcher.add_handler(TypeHandler(SnapshotRequest, write_snapshot), group=-1)
+    dispatcher.add_handler(TypeHandler(Update, mark_conversation_resumed), group=-2)
+    # Hanya admin (ADMIN_IDS) yang boleh melihat statistik; tanpa ADMIN_IDS perintah ini nonaktif
+    dispatcher.add_handler(CommandHandler('stats', stats, filters=Filters.user(user_id=ADMIN_IDS)))
     # Fallback untuk jika user menekan tombol dari pesan lama
     dispatcher.add_handler(CallbackQueryHandler(lambda u,c: start(u,c,is_restart=True)))
 
 
+    dispatcher.job_queue.run_repeating(request_snapshot, PERSISTENCE_INTERVAL, first=PERSISTENCE_INTERVAL)
+
     updater.start_polling()
+    # Didaftarkan setelah job queue berjalan dengan `first` positif: waktu mulai yang sudah lewat
+    # saat scheduler start membuat APScheduler menunda run pertama satu interval penuh
+    dispatcher.job_queue.run_repeating(refresh_sheet_index, SHEET_INDEX_REFRESH, first=1)
     logger.info("Bot PJR by Edp Toko sudah berjalan...")
     updater.idle()
 